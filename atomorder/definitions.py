@@ -1,5 +1,14 @@
 import numpy as np
 
+def _pair_key(element1, element2):
+    """
+    Canonical (sorted) dictionary key of an element pair
+
+    """
+    if element1 <= element2:
+        return (element1, element2)
+    return (element2, element1)
+
 class Constants(object):
     """
     Constants()
@@ -10,18 +19,51 @@ class Constants(object):
     Attributes
     ----------
     bond_length_limits: dict
-        Dictionary of loose and tight distance limits on bond lengths
+        Dictionary of loose and tight distance limits on bond lengths.
+        Only the sorted element pair is stored, see get_bond_length_limits
+    atomic_numbers: dict
+        Atomic numbers of the supported element symbols
+    bond_limits_arr: array
+        (Zmax+1)x(Zmax+1)x4 sized array of the distance limits in bond_length_limits
+        indexed by the atomic numbers of the two elements
+    bond_limits: array
+        (Zmax+1)x(Zmax+1) sized structured view of bond_limits_arr with the fields
+        loose_lower, lower, upper and loose_upper
+    loose_lower_limits, lower_limits, upper_limits, loose_upper_limits: array
+        (Zmax+1)x(Zmax+1) sized contiguous arrays of each of the limits in bond_limits_arr
     number_bonds: dict
         Number of bonds the supported atom types can form
-    monovalent: list
+    valence_mask: array
+        Bitmask of number_bonds indexed by atomic number,
+        where bit k is set if the element can form k bonds
+    monovalent: frozenset
         Monovalent atom types
+    monovalent_Z: frozenset
+        Atomic numbers of the monovalent atom types
+    monovalent_mask: array
+        Bool array indexed by atomic number that is True for the monovalent atom types
 
     """
+    __slots__ = ("bond_length_limits", "atomic_numbers", "bond_limits_arr", "bond_limits",
+                 "loose_lower_limits", "lower_limits", "upper_limits", "loose_upper_limits",
+                 "number_bonds", "valence_mask", "monovalent",
+                 "monovalent_Z", "monovalent_mask", "sybyl_bonds")
+
+    # The constants never change after construction, so all
+    # instances are the same object that is only built once
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(Constants, cls).__new__(cls)
+            cls._instance.initialize()
+        return cls._instance
+
     # TODO replace this with a hidden markov model or similar
-    def __init__(self):
+    def initialize(self):
 
         # Found from analyzing the CCDC 2016 database.
-        # loose_lower, lower, loose_upper, upper
+        # loose_lower, lower, upper, loose_upper
         self.bond_length_limits = {#("As","As"): (2.20, 2.30, 2.65, 2.80),
                                    #("As","Br"): (2.20, 2.30, 3.30, 3.40),
                                    #("As","Cl"): (2.10, 2.15, 2.40, 3.30),
@@ -75,9 +117,53 @@ class Constants(object):
         # didn't have many S-H hits, so guesstimate them
         self.bond_length_limits[("H","S")] = (1.2,1.3,1.4,1.5)
 
-        ## make inverse atom order
-        #for key, value in self.bond_length_limits.items():
-        #    self.bond_length_limits[key[::-1]] = value
+        # Atomic numbers of the elements that have bond length limits.
+        # Deuterium shares the limits of hydrogen.
+        self.atomic_numbers = {"H" : 1,
+                               "D" : 1,
+                               "C" : 6,
+                               "N" : 7,
+                               "O" : 8,
+                               "F" : 9,
+                               "P" : 15,
+                               "S" : 16,
+                               "Cl": 17,
+                               "As": 33,
+                               "Br": 35,
+                               "I" : 53
+                               }
+
+        # Lookup table of the bond length limits indexed by atomic numbers,
+        # such that limits for all pairs in a molecule can be gathered at once.
+        # Index 0 is reserved for unsupported elements and
+        # has limits such that no bonds are formed
+        z_max = max(self.atomic_numbers.values())
+        self.bond_limits_arr = np.zeros((z_max+1, z_max+1, 4), dtype=np.float32)
+        pairs = list(self.bond_length_limits.items())
+        for (element1, element2), limits in pairs:
+            z1, z2 = self.atomic_numbers[element1], self.atomic_numbers[element2]
+            self.bond_limits_arr[z1, z2] = limits
+            self.bond_limits_arr[z2, z1] = limits
+        self.bond_limits_arr.flags.writeable = False
+        # Record view of the same table, such that the limits
+        # of a pair can be accessed by name
+        bond_limits_dtype = np.dtype([("loose_lower", np.float32), ("lower", np.float32),
+                                      ("upper", np.float32), ("loose_upper", np.float32)])
+        self.bond_limits = self.bond_limits_arr.view(bond_limits_dtype)[..., 0]
+
+        # Each limit as a separate contiguous array for
+        # vectorized classification of many pairs at once
+        bond_limits_soa = np.ascontiguousarray(np.rollaxis(self.bond_limits_arr, 2))
+        bond_limits_soa.flags.writeable = False
+        self.loose_lower_limits, self.lower_limits, self.upper_limits, self.loose_upper_limits = bond_limits_soa
+
+        # The dictionary values are views of the lookup table,
+        # so the limits are only stored once.
+        # Only the canonical atom order is stored.
+        self.bond_length_limits = {}
+        for (element1, element2), _ in pairs:
+            z1, z2 = self.atomic_numbers[element1], self.atomic_numbers[element2]
+            self.bond_length_limits[_pair_key(element1, element2)] = self.bond_limits_arr[z1, z2]
 
         # Number of bonds each atom type commonly form
         # Doubles as list of atom types implemented
@@ -93,8 +179,20 @@ class Constants(object):
                              "P" : np.asarray( [3]      , dtype=int) ,
                              "S" : np.asarray( [1,2,3,4], dtype=int)
                              }
+        for possible_num_bonds in self.number_bonds.values():
+            possible_num_bonds.flags.writeable = False
+
+        self.valence_mask = np.zeros(z_max+1, dtype=np.uint8)
+        for element, possible_num_bonds in self.number_bonds.items():
+            for num_bonds in possible_num_bonds:
+                self.valence_mask[self.atomic_numbers[element]] |= (1 << num_bonds)
+        self.valence_mask.flags.writeable = False
         # monovalent atoms
-        self.monovalent = ["Br","Cl","F","H","D","I"]
+        self.monovalent = frozenset(("Br","Cl","F","H","D","I"))
+        self.monovalent_Z = frozenset(self.atomic_numbers[element] for element in self.monovalent)
+        self.monovalent_mask = np.zeros(z_max+1, dtype=bool)
+        self.monovalent_mask[list(self.monovalent_Z)] = True
+        self.monovalent_mask.flags.writeable = False
 
         # Properties of different sybyl atom types for bonding
         # This is for very internal use. Basically the properties are
@@ -126,15 +224,84 @@ class Constants(object):
                             }
 
     def get_bond_length_limits(self, element1, element2):
-        if element1 > element2:
-            element1, element2 = element2, element1
+        """
+        Bond length limits from element symbols, in any order.
+        Looked up by atomic number, like get_limits, such that
+        deuterium shares the limits of hydrogen.
+
+        """
+        # Unsupported elements get the atomic number 0,
+        # which has limits such that no bonds are formed
+        z1 = self.atomic_numbers.get(element1, 0)
+        z2 = self.atomic_numbers.get(element2, 0)
+        return self.bond_limits_arr[z1, z2]
+
+    def get_limits(self, z1, z2):
+        """
+        Bond length limits from atomic numbers.
+        z1 and z2 can be integers or arrays of integers.
+
+        """
+        return self.bond_limits_arr[z1, z2]
+
+    def classify_bonds(self, z1, z2, distances):
+        """
+        Classify atom pairs as bonds from their distances
+
+        Parameters
+        ----------
+        z1, z2: array
+            Atomic numbers of the atoms in each pair
+        distances: array
+            Distances between the atoms in each pair
+
+        Returns
+        -------
+        credible_bonds: array
+            Bool array of pairs within the usual bond length range
+        less_credible_bonds: array
+            Bool array of pairs outside the usual range, but within the loose range
+
+        """
+        bond_classes = self.get_bond_classes(z1, z2, distances)
+        credible_bonds = (bond_classes == 2)
+        less_credible_bonds = (bond_classes == 1) | (bond_classes == 3)
+        return credible_bonds, less_credible_bonds
+
+    def get_bond_classes(self, z1, z2, distances):
+        """
+        Integer bond class of atom pairs from their distances
+
+        Parameters
+        ----------
+        z1, z2: array
+            Atomic numbers of the atoms in each pair
+        distances: array
+            Distances between the atoms in each pair
+
+        Returns
+        -------
+        bond_classes: array
+            0 if the pair is not bonded, 1 if the distance is in the loose range
+            below the usual range, 2 if it is in the usual range and 3 if it is in
+            the loose range above the usual range
 
-        if (element1, element2) in self.bond_length_limits:
-            return self.bond_length_limits[(element1, element2)]
+        """
+        distances = np.asarray(distances)
+        within_loose_limits = (distances >= self.loose_lower_limits[z1, z2]) \
+                              & (distances <= self.loose_upper_limits[z1, z2])
+        bond_classes = 1 + (distances >= self.lower_limits[z1, z2]).astype(np.int8) \
+                         + (distances > self.upper_limits[z1, z2])
+        bond_classes[~within_loose_limits] = 0
+        return bond_classes
+
+    def get_atomic_numbers(self, element_symbols):
+        """
+        Atomic numbers of the given element symbols.
+        Unsupported elements are given the atomic number 0.
 
-        # Return limits such that no bonds are formed
-        # if the elements are not in self.bond_length_limits
-        return (0,0,0,0)
+        """
+        return np.asarray([self.atomic_numbers.get(element, 0) for element in element_symbols], dtype=int)
 
 class Settings(object):
     """
@@ -149,6 +316,9 @@ class Settings(object):
         Coordinate files for reactants
     product_filenames: list
         Coordinate files for products
+    force_numerical: bool
+        Use the fully numerical rotation solver for all numbers of
+        reactants and products
     #TODO
 
     """
@@ -161,6 +331,7 @@ class Settings(object):
         self.create_atoms = False
         self.rotation_objective = False
         self.bond_objective = False
+        self.force_numerical = False
 
     def update(self, args):
         """
@@ -179,6 +350,7 @@ class Settings(object):
 
         self.atomic_sybyl_weight = args.atomic_sybyl_weight
         self.bond_weight = args.bond_weight
+        self.force_numerical = args.force_numerical
         self.hydrogen_rotation_weight = 1.0
         self.annealing_method = "multiplication" # multiplication/addition
         #self.annealing_method = "addition"
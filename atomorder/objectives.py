@@ -7,10 +7,10 @@ all scoring functions (objectives)
 
 import numpy as np
 import scipy.optimize
+import scipy.linalg.lapack
+import scipy.sparse
 from . import settings
-import itertools
-from .utils import eprint, oprint
-from .parsers import write_xyz, write_mol2
+from .utils import eprint, oprint, get_squared_distance_matrix
 
 # TODO options ignore monovalent / ignore hydrogens
 
@@ -40,14 +40,19 @@ class Rotation(object):
         bool array where all reactant non-hydrogen atoms are True
     product_hydrogen_mask: array
         bool array where all product non-hydrogen atoms are True
-    W: array
-        Page 363 Walker91
-    Q: array
-        Page 363 Walker91
-    Qt_dot_W: array
-        Page 363 Walker91
-    W_minus_Q: array
-        Page 363 Walker91
+    W_basis: array
+        W (eqn 16 Walker91) of the four unit vectors
+    Q_basis: array
+        Q (eqn 15 Walker91) of the four unit vectors
+    Qt_dot_W_basis: array
+        Q.T*W (page 363 Walker91) of all pairs of the first three unit vectors
+    pair_indices: dict
+        Sub matrix indices of every (reactant, product) pair,
+        keyed by the pair of subset numbers
+    X_outer: array
+        N*3*3 sized array with the outer product of each reactant coordinate with itself
+    Y_outer: array
+        N*3*3 sized array with the outer product of each product coordinate with itself
     q: array
         Each rotation and transformation is defined by a dual quaternion.
         q is the set of all quaternions, where q[0,0] = s1, q[0,1] = r1, q[1,0] = s2 etc.
@@ -59,15 +64,28 @@ class Rotation(object):
     def __init__(self, M):
         oprint(3, "Initializing rotation objective")
         self.M = M
-        self.X = self.M.reactants_coordinates
-        self.Y = self.M.products_coordinates
+        # make sure that all the dot products use contiguous double precision arrays
+        self.X = np.ascontiguousarray(self.M.reactants_coordinates, dtype=np.float64)
+        self.Y = np.ascontiguousarray(self.M.products_coordinates, dtype=np.float64)
         self.reactant_hydrogen_mask = (self.M.reactants_elements == "H") | (self.M.reactants_elements == "D")
         self.product_hydrogen_mask = (self.M.products_elements == "H") | (self.M.products_elements == "D")
         self.score = self.set_solver()
         self.q = self.initialize_quaternions()
-        self.W, self.Q, self.Qt_dot_W, self.W_minus_Q = self.interaction_arrays()
+        # W and Q are linear in r, so W(r) and Q(r) are linear
+        # combinations of the constant W and Q of the unit vectors
+        self.W_basis = np.asarray([self.makeW(*e) for e in np.eye(4)])
+        self.Q_basis = np.asarray([self.makeQ(*e) for e in np.eye(4)])
+        # Q(y).T*W(x) is bilinear in x and y
+        self.Qt_dot_W_basis = np.einsum('lca,kcb->klab', self.Q_basis[:3], self.W_basis[:3])
+        self.pair_indices = self.get_pair_indices()
+        # outer products of the coordinates of each atom with itself,
+        # used for the second moments in get_pair_moments
+        self.X_outer = self.X[:,:,None] * self.X[:,None,:]
+        self.Y_outer = self.Y[:,:,None] * self.Y[:,None,:]
+        # reusable scratch arrays for the squared distances of each block
+        self.distance_buffers = {}
         # only used in numeric part
-        self.squared_distances = np.zeros(self.M.match_matrix.shape, dtype=float)
+        self.squared_distances = np.zeros(self.M.match_matrix.shape, dtype=np.float64, order='C')
 
     def initialize_quaternions(self):
         """
@@ -79,8 +97,9 @@ class Rotation(object):
         """
         # initialize as s = (0,0,0,0) and r = (0,0,0,1)
         N, M = self.M.num_reactants, self.M.num_products
-        # only use three elements and enforce constraints in the fourth
-        q = np.zeros((N-1, 2, 3))
+        # only use three elements and enforce constraints in the fourth.
+        # Only the products other than the reference are fitted numerically
+        q = np.zeros((M-1, 2, 3))
         #q[:,1,3] = 1
         return q
 
@@ -91,6 +110,8 @@ class Rotation(object):
 
         """
         # TODO: solve general case analytically or iterative solver
+        if settings.force_numerical:
+            return self.numerical_solver
         if self.M.num_reactants == 1 or self.M.num_products == 1:
             return self.analytical_solver
         else:
@@ -119,45 +140,39 @@ class Rotation(object):
 
         #if self.M.it < 0:
         #    return np.zeros(match.shape)
-        E = 0
         match = m.copy()
 
-        # Pick first reactant as reference state
-        ref_indices = self.M.reactant_subset_indices[0]
-        Y0 = self.Y[ref_indices]
-
-        squared_distances = np.zeros(self.M.match_matrix.shape, dtype=float)
+        squared_distances = np.zeros(self.M.match_matrix.shape, dtype=np.float64, order='C')
 
         match[np.ix_(self.reactant_hydrogen_mask, self.product_hydrogen_mask)] *= settings.hydrogen_rotation_weight
-        all_X  = []
+
+        # The interaction arrays are linear or bilinear in the coordinates,
+        # so C1, C2 and C3 of every (reactant, product) pair follow
+        # directly from the match weighted moments
+        S0, x_sum, y_sum, _, _, cross_moment = self.get_pair_moments(match)
+        C1 = -2*np.tensordot(cross_moment, self.Qt_dot_W_basis, 2)
+        C2 = S0
+        C3 = 2*(np.tensordot(x_sum, self.W_basis[:3], 1) - np.tensordot(y_sum, self.Q_basis[:3], 1))
+        A = 0.5*(np.einsum('ijba,ijbc->ijac', C3, C3)/(2.0*C2[:,:,None,None]) - C1 - C1.transpose(0,1,3,2))
+
+        # optimal rotation and translation of every pair
+        N, M = A.shape[:2]
+        r = np.asarray([self.largest_eigenvector(a) for a in A.reshape(-1,4,4)]).reshape(N,M,4)
+        s = -np.einsum('ijab,ijb->ija', C3, r)/(2.0*C2[:,:,None])
+        all_rot, all_trans = self.transform_batch(r.reshape(-1,4), s.reshape(-1,4))
+        all_rot, all_trans = all_rot.reshape(N,M,3,3), all_trans.reshape(N,M,3)
+
         for i, reactant_indices in enumerate(self.M.reactant_subset_indices):
             X = self.X[reactant_indices]
             for j, product_indices in enumerate(self.M.product_subset_indices):
                 Y = self.Y[product_indices]
-                sub_matrix_indices = np.ix_(reactant_indices, product_indices)
-                match_sub_matrix = match[sub_matrix_indices]
-                Qt_dot_W = self.Qt_dot_W[sub_matrix_indices]
-                W_minus_Q = self.W_minus_Q[sub_matrix_indices]
-
-                C1 = -2*np.sum(match_sub_matrix[:,:,None,None]*Qt_dot_W,axis=(0,1))
-                C2 = match_sub_matrix.sum()
-                C3 = 2*np.sum(match_sub_matrix[:,:,None,None]*W_minus_Q,axis=(0,1))
-                A = 0.5*(C3.T.dot(C3)/(2.0*C2)-C1-C1.T)
-                # TODO remove
-                assert(np.allclose(A,A.T))
-                eigen = np.linalg.eigh(A)
-                r = eigen[1][:,-1]
-                # TODO remove
-                assert(np.allclose(A.dot(r), eigen[0][-1]*r))
-                s = -C3.dot(r)/(2.0*C2)
-                rot, trans = self.transform(r,s)
-
-                squared_distances[sub_matrix_indices] = np.sum((Y[None,:,:] - trans[None,None,:] - rot.dot(X.T).T[:,None,:])**2, axis=2)
-            all_X.append(trans + rot.dot(X.T).T)
+                sub_matrix_indices = self.pair_indices[i,j]
+                rot, trans = all_rot[i,j], all_trans[i,j]
+
+                squared_distances[sub_matrix_indices] = get_squared_distance_matrix(trans + X.dot(rot.T), Y,
+                        out=self.get_distance_buffer(X.shape[0], Y.shape[0]))
 
         squared_distances[np.ix_(self.reactant_hydrogen_mask, self.product_hydrogen_mask)] *= settings.hydrogen_rotation_weight
-        write_mol2(np.concatenate(all_X), self.M.reaction.reactants.atoms, "reactant%d.mol2" % self.M.it,self.M.reaction.num_reactant_atoms)
-        write_mol2(self.Y+np.asarray([10,0,0]), self.M.reaction.products.atoms, "product%d.mol2" % self.M.it, self.M.reaction.num_product_atoms, match)
 
         return squared_distances
 
@@ -181,98 +196,81 @@ class Rotation(object):
 
         """
 
-        def objective(flat_q, match, self):#, jac):
-            # TODO jacobian could be written in matrix form.
+        # The optimizer can evaluate the objective at the same point
+        # more than once, so keep the results of the last two evaluations
+        cache = []
+
+        match = match.copy()
+        match[np.ix_(self.reactant_hydrogen_mask, self.product_hydrogen_mask)] *= settings.hydrogen_rotation_weight
+        # The match matrix is fixed during the optimization,
+        # so the match weighted moments of every (reactant, product)
+        # pair can be computed once
+        pair_moments = self.get_pair_moments(match)
+
+        def objective(flat_v, match, self, jac = False, get_squared_distances = False):
             # TODO add penalty for clashing in the numerical version
 
+            key = (flat_v.tobytes(), jac)
+            if not get_squared_distances:
+                for cached_key, cached_result in cache:
+                    if cached_key == key:
+                        return cached_result
+
             # size
             N, M = self.M.num_reactants, self.M.num_products
-            # energy
-            E = 0
-
-            #if jac:
-            #    J = np.zeros(8*(N+M-1))
 
-            q = flat_q.reshape(N+M-1,2,4)
-            # There's N+M-1 pairs of r,s.
+            v = flat_v.reshape(N+M-1,2,4)
+            # There's N+M-1 pairs of r,s. The first N transform the reactants
+            # and the last M-1 the products other than the reference.
+            # The dual quaternion constraints r.T*r = 1 and r.T*s = 0 are
+            # enforced by the parametrization, such that the problem is
+            # unconstrained: r is the normalized v[:,1] and s is v[:,0]
+            # with the component along r removed.
+            r_norm = np.sqrt(np.einsum('ki,ki->k', v[:,1], v[:,1]))[:,None]
+            r = v[:,1] / r_norm
+            s_projection = np.einsum('ki,ki->k', v[:,0], r)[:,None]
+            s = v[:,0] - s_projection * r
             # construct rotation matrices and translation vectors
-            trans = np.zeros((N+M-1, 3))
-            rot = np.zeros((N+M-1, 3, 3))
-            for j in xrange(M):
-                rot[j], trans[j] = self.transform(q[j, 1], q[j, 0])
-            for i in xrange(N-1):
-                rot[M+i], trans[M+i] = self.transform(q[M+i,1], q[M+i, 0])
-
-            # use product 1 as reference
-            ref_indices = self.M.product_subset_indices[0]
-            Y0 = self.Y[ref_indices]
-            squared_distances = np.zeros(match.shape)
-            all_X = []
-            all_Y = []
-            for j, reactant_indices in enumerate(self.M.reactant_subset_indices):
-                # contribution between reactants and product 1
-                X = self.X[reactant_indices]
-                #match_sub_matrix = match[np.ix_(ref_indices, product_indices)]
-                squared_distances[np.ix_(reactant_indices, ref_indices)] = np.sum((Y0[None,:,:] - trans[j][None,None,:] - rot[j].dot(X.T).T[:,None,:])**2, axis=2)
-
-
-                # contributions between products and remaining reactants
-                for i, product_indices in enumerate(self.M.product_subset_indices[1:]):
-                    Y = self.Y[product_indices]
-                    #match_sub_matrix = match[np.ix_(reactant_indices, product_indices)]
-                    squared_distances[np.ix_(reactant_indices, product_indices)] = np.sum((trans[M+i][None,None,:] + (rot[M+i].dot(Y.T).T)[None,:,:] - trans[j][None,None,:] - (rot[j].dot(X.T).T)[:,None,:])**2, axis=2)
-
-            for j, reactant_indices in enumerate(self.M.reactant_subset_indices):
-                all_X.append(trans[j] + rot[j].dot(self.X[reactant_indices].T).T)
-            all_Y.append(Y0)
-            for i, reactant_indices in enumerate(self.M.reactant_subset_indices[1:]):
-                all_Y.append(trans[M+i] + rot[M+i].dot(self.Y[product_indices].T).T)
-            write_xyz(np.concatenate(all_X), self.M.reactants_elements, "reactant%d.xyz" % self.M.it, str(np.sum(match*squared_distances)))
-            write_xyz(np.concatenate(all_Y), self.M.products_elements, "product%d.xyz" % self.M.it, str(np.sum(match*squared_distances)))
-            E = np.sum(match*squared_distances)
-            self.squared_distances = squared_distances.copy()
+            # W_r and Q_r are reused in the chain rule of the gradient
+            rot, trans, W_r, Q_r = self.transform_batch(r, s, return_matrices = True)
 
-            return E
+            if get_squared_distances:
+                # Only needed once the optimization is done
+                return self.get_transformed_squared_distances(rot, trans)
 
+            # The energy and its gradient are computed together from the moments,
+            # without forming the distance matrix
+            E, rot_grad, trans_grad = self.moment_energy(rot, trans, pair_moments, jac)
 
-        def rr_constraint_jacobian(x, j, N, M):
-            # jacobian for use with SLSQP
-            jac = np.zeros(8*(M+N-1))
-            jac[8*j+4:8*j+8] = 2*x[8*j+4:8*j+8]
-            return jac
+            if jac:
+                r_grad, s_grad = self.transform_gradient(W_r, Q_r, s, rot_grad, trans_grad)
+                # chain rule through the projection of s and the normalization of r
+                r_grad -= np.einsum('ki,ki->k', s_grad, r)[:,None] * v[:,0] + s_projection * s_grad
+                J = np.empty(v.shape)
+                J[:,0] = s_grad - np.einsum('ki,ki->k', s_grad, r)[:,None] * r
+                J[:,1] = (r_grad - np.einsum('ki,ki->k', r_grad, r)[:,None] * r) / r_norm
+                result = E, J.ravel()
+            else:
+                result = E
 
-        def rs_constraint_jacobian(x, j, N, M):
-            # jacobian for use with SLSQP
-            jac = np.zeros(8*(M+N-1))
-            jac[8*j:8*j+4] = x[8*j+4:8*j+8]
-            jac[8*j+4:8*j+8] = x[8*j:8*j+4]
-            return jac
+            cache.append((key, result))
+            del cache[:-2]
 
+            return result
 
         N, M = self.M.num_reactants, self.M.num_products
-        # create constraints
-        cons = np.empty(2*(N+M-1), dtype=dict)
-
-        for j in range(M+N-1):
-            cons[2*j]   = {"type": "eq", "fun": lambda x: np.sum(x[8*j+4:8*j+8]*x[8*j+4:8*j+8]) -1} # r.T*r = 1
-            cons[2*j+1] = {"type": "eq", "fun": lambda x: np.sum(x[8*j+4:8*j+8]*x[8*j:8*j+4])} # r.T*s = 0
 
-            # jacobians for SLSQP
-            cons[2*j]["jac"] = lambda x: rr_constraint_jacobian(x, j, N, M)
-            cons[2*j+1]["jac"] = lambda x: rs_constraint_jacobian(x, j, N, M)
+        v = np.zeros((N+M-1, 2, 4))
+        v[:,1,3] = 1
 
-
-        bounds = []
-        for j in range(M+N-1):
-            bounds.extend([(None, None)]*4)
-            bounds.extend([(-1, 1)]*4)
-
-        q = np.zeros((N+M-1, 2, 4))
-        q[:,1,3] = 1
-
-        objective(q, match, self)
-        opt = scipy.optimize.minimize(objective, q, constraints=cons, method="SLSQP", options={"maxiter": 500, "disp": 0, "ftol": 1e-4}, args=(match, self), bounds=bounds)
-        squared_distances = self.squared_distances.copy()
+        # ftol is relative to the energy, which is large compared to the
+        # energy differences near the minimum, so tight tolerances are needed
+        # to reach the same minimum as the constrained fit
+        opt = scipy.optimize.minimize(objective, v.ravel(), jac=True, method="l-bfgs-b",
+                                      options={"maxiter": 500, "disp": 0, "ftol": 1e-10, "gtol": 1e-8}, args=(match, self, True))
+        squared_distances = objective(opt.x, match, self, False, True)
+        squared_distances[np.ix_(self.reactant_hydrogen_mask, self.product_hydrogen_mask)] *= settings.hydrogen_rotation_weight
+        self.squared_distances = squared_distances
         #self.update_quaternions(opt.x.reshape((N+M-1),2,4))
         return self.squared_distances
 
@@ -289,118 +287,85 @@ class Rotation(object):
 
         """
 
-        def objective(flat_q, m, self):
-            match = m.copy()
+        def objective(flat_q, match, self, get_squared_distances = False):
 
             # size
             N, M = self.M.num_reactants, self.M.num_products
-            squared_distances = np.zeros(match.shape)
-            # energy
-            E = 0
 
             # reshape
-            q = flat_q.reshape(N-1,2,3)
-            # add restraints as in the fourth element in the quaternions
-            q = np.concatenate([q, np.zeros((N-1,2,1))], axis=2)
-
-            # There's N-1 pairs of r,s that has to be solved numerically
-            # construct rotation matrices and translation vectors
-            trans = np.zeros((N-1, 3))
-            rot = np.zeros((N-1, 3, 3))
-            for j in xrange(N-1):
-                # r restraints
-                r4_sq = 1 - q[j,1,0]**2 - q[j,1,1]**2 - q[j,1,2]**2
-                if r4_sq < 0:
+            q = flat_q.reshape(M-1,2,3)
+            # There's M-1 pairs of r,s, one for each product other than
+            # the reference, that has to be solved numerically.
+            # Read them into contiguous arrays once, with room for
+            # the restraints as the fourth element in the quaternions
+            product_s = np.zeros((M-1,4))
+            product_r = np.zeros((M-1,4))
+            product_s[:,:3] = q[:,0]
+            product_r[:,:3] = q[:,1]
+
+            # r restraints
+            r4_sq = 1 - np.einsum('ki,ki->k', product_r, product_r)
+            outside = (r4_sq < 0)
+            if outside.any():
+                if not get_squared_distances:
                     return np.inf
-                q[j,1,3] = np.sqrt(r4_sq)
-                # s restraints
-                s4 = - (q[j,0,0]*q[j,1,0] + q[j,0,1]*q[j,1,1] + q[j,0,2]*q[j,1,2])/q[j,1,3]
-                rot[j], trans[j] = self.transform(q[j, 1], q[j, 0])
-
-            ## use product 1 as reference
-            #match[np.ix_(self.reactant_hydrogen_mask, self.product_hydrogen_mask)] *= settings.hydrogen_rotation_weight
-            #for i, reactant_indices in enumerate(self.M.reactant_subset_indices):
-            #    X = self.X[reactant_indices]
-            #    for j, product_indices in enumerate(self.M.product_subset_indices):
-            #        # solve everything other than internal product rotations analytically
-            #        if j == 0:
-            #            Y = self.Y[product_indices]
-            #        else:
-            #            Y = trans[j-1] + rot[j-1].dot(self.Y[product_indices].T).T
-
-            #        sub_matrix_indices = np.ix_(reactant_indices, product_indices)
-            #        match_sub_matrix = match[sub_matrix_indices]
-            #        #Qt_dot_W = self.Qt_dot_W[sub_matrix_indices]
-            #        #W_minus_Q = self.W_minus_Q[sub_matrix_indices]
-            #        Q = np.asarray([self.makeQ(*y) for y in Y])
-            #        Qt_dot_W = np.asarray([[np.dot(q.T,w) for q in Q] for w in self.W[reactant_indices]])
-            #        W_minus_Q = np.asarray([[w - q for q in Q] for w in self.W[reactant_indices]])
-
-            #        C1 = -2*np.sum(match_sub_matrix[:,:,None,None]*Qt_dot_W,axis=(0,1))
-            #        C2 = match_sub_matrix.sum()
-            #        C3 = 2*np.sum(match_sub_matrix[:,:,None,None]*W_minus_Q,axis=(0,1))
-            #        A = 0.5*(C3.T.dot(C3)/(2.0*C2)-C1-C1.T)
-            #        # TODO remove
-            #        assert(np.allclose(A,A.T))
-            #        eigen = np.linalg.eigh(A)
-            #        r = eigen[1][:,-1]
-            #        # TODO remove
-            #        assert(np.allclose(A.dot(r), eigen[0][-1]*r))
-            #        s = -C3.dot(r)/(2.0*C2)
-            #        xrot, xtrans = self.transform(r,s)
-
-            #        #all_X.append(xtrans + xrot.dot(X.T).T)
-            #        #all_Y.append(Y)
-
-            #        squared_distances[sub_matrix_indices] = np.sum((Y[None,:,:] - xtrans[None,None,:] - xrot.dot(X.T).T[:,None,:])**2, axis=2)
-
-            #squared_distances[np.ix_(self.reactant_hydrogen_mask, self.product_hydrogen_mask)] *= settings.hydrogen_rotation_weight
-            #E += np.sum(m*squared_distances)
-            #self.squared_distances = squared_distances.copy()
+                # The distances are always needed at the final point,
+                # so put r back on the unit sphere there
+                product_r[outside] /= np.sqrt(1 - r4_sq[outside])[:,None]
+                r4_sq[outside] = 0
+            product_r[:,3] = np.sqrt(r4_sq)
+            # construct rotation matrices and translation vectors
+            rot, trans = self.transform_batch(product_r, product_s)
+
+            # The interaction arrays of each reactant with the transformed products
+            # are linear in the match weighted moments, so get the moments
+            # of the transformed products from the fixed ones.
+            # Product 1 is the reference, which is not transformed.
+            product_rot = np.concatenate([np.identity(3)[None], rot])
+            product_trans = np.concatenate([np.zeros((1,3)), trans])
+            S0, x_sum, y_sum, x_moment, y_moment, cross_moment = pair_moments
+            rotated_y_sum = np.einsum('jab,ijb->ija', product_rot, y_sum)
+            cross_moment = np.einsum('ijab,jcb->iac', cross_moment, product_rot) \
+                           + np.einsum('ija,jb->iab', x_sum, product_trans)
+            y_sum = rotated_y_sum.sum(1) + S0.dot(product_trans)
+            x_sum = x_sum.sum(1)
+
+            C2 = S0.sum(1)
+            C1 = -2*np.tensordot(cross_moment, self.Qt_dot_W_basis, 2)
+            C3 = 2*(np.tensordot(x_sum, self.W_basis[:3], 1) - np.tensordot(y_sum, self.Q_basis[:3], 1))
+            # 1e-9 for stability
+            A = 0.5*(np.einsum('iba,ibc->iac', C3, C3)/(2.0*C2[:,None,None]+1e-9) - C1 - C1.transpose(0,2,1))
+
+            # For the optimal r and s, the weighted sum of squared distances
+            # reduces to C0 - r.T*A*r, such that the distances themselves
+            # are only needed at the final solution
+            C0 = np.einsum('ijaa->i', x_moment) + np.einsum('jab,ijbc,jac->i', product_rot, y_moment, product_rot) \
+                 + 2*np.einsum('ija,ja->i', rotated_y_sum, product_trans) + S0.dot(np.einsum('ja,ja->j', product_trans, product_trans))
+
+            r = np.asarray([self.largest_eigenvector(A[i]) for i in range(N)])
+            E = np.sum(C0) - np.einsum('ia,iab,ib->', r, A, r)
+
+            if not get_squared_distances:
+                return E
 
             Y = []
             for j,  product_indices in enumerate(self.M.product_subset_indices):
-                if j == 0:
-                    Y.append(self.Y[product_indices])
-                else:
-                    Y.append(trans[j-1] + rot[j-1].dot(self.Y[product_indices].T).T)
+                Y.append(product_trans[j] + self.Y[product_indices].dot(product_rot[j].T))
             Y = np.concatenate(Y)
-            all_X = []
+            # optimal rotation and translation of every reactant
+            s = -np.einsum('iab,ib->ia', C3, r)/(2.0*C2[:,None])
+            all_xrot, all_xtrans = self.transform_batch(r, s)
+            squared_distances = np.zeros(match.shape, dtype=np.float64, order='C')
             for i, reactant_indices in enumerate(self.M.reactant_subset_indices):
                 X = self.X[reactant_indices]
-                Q = np.asarray([self.makeQ(*y) for y in Y])
-                Qt_dot_W = np.asarray([[np.dot(q.T,w) for q in Q] for w in self.W[reactant_indices]])
-                W_minus_Q = np.asarray([[w - q for q in Q] for w in self.W[reactant_indices]])
-                match_sub_matrix = match[reactant_indices,:]
-
-                C1 = -2*np.sum(match_sub_matrix[:,:,None,None]*Qt_dot_W,axis=(0,1))
-                C2 = match_sub_matrix.sum()
-                C3 = 2*np.sum(match_sub_matrix[:,:,None,None]*W_minus_Q,axis=(0,1))
-                # 1e-9 for stability
-                A = 0.5*(C3.T.dot(C3)/(2.0*C2+1e-9)-C1-C1.T)
-                # TODO remove
-                assert(np.allclose(A,A.T))
-                eigen = np.linalg.eigh(A)
-                r = eigen[1][:,-1]
-                # TODO remove
-                assert(np.allclose(A.dot(r), eigen[0][-1]*r))
-                s = -C3.dot(r)/(2.0*C2)
-                xrot, xtrans = self.transform(r,s)
-
-                #all_X.append(xtrans + xrot.dot(X.T).T)
-                #all_Y.append(Y)
-                all_X.append(xtrans + xrot.dot(X.T).T)
-
-                squared_distances[reactant_indices,:] = np.sum((Y[None,:,:] - xtrans[None,None,:] - xrot.dot(X.T).T[:,None,:])**2, axis=2)
-            for i, v in enumerate(all_X):
-                all_X[i] += np.asarray([1*i,0,0])
-            #write_xyz(np.concatenate(all_X), self.M.reactants_elements, "reactant%d.xyz" % self.M.it, str(np.sum(match*squared_distances)))
-            #write_xyz(Y, self.M.products_elements, "product%d.xyz" % self.M.it, str(np.sum(match*squared_distances)))
-            write_mol2(np.concatenate(all_X), self.M.reaction.reactants.atoms, "reactant%d.mol2" % self.M.it,self.M.reaction.num_reactant_atoms)
-            write_mol2(Y+np.asarray([10,0,0]), self.M.reaction.products.atoms, "product%d.mol2" % self.M.it, self.M.reaction.num_product_atoms, match)
+                xrot, xtrans = all_xrot[i], all_xtrans[i]
+
+                X_trans = xtrans + X.dot(xrot.T)
+
+                squared_distances[reactant_indices,:] = get_squared_distance_matrix(X_trans, Y,
+                        out=self.get_distance_buffer(X.shape[0], Y.shape[0]))
 
             squared_distances[np.ix_(self.reactant_hydrogen_mask, self.product_hydrogen_mask)] *= settings.hydrogen_rotation_weight
-            E += np.sum(m*squared_distances)
             self.squared_distances = squared_distances.copy()
             #for i, xi in enumerate(all_X):
             #    for xj in all_X[i+1:]:
@@ -417,8 +382,16 @@ class Rotation(object):
             return E
 
         N, M = self.M.num_reactants, self.M.num_products
+
+        match = match.copy()
+        match[np.ix_(self.reactant_hydrogen_mask, self.product_hydrogen_mask)] *= settings.hydrogen_rotation_weight
+        # The match matrix is fixed during the optimization,
+        # so the match weighted moments of every (reactant, product)
+        # pair can be computed once
+        pair_moments = self.get_pair_moments(match)
+
         bounds = []
-        for j in range(N-1):
+        for j in range(M-1):
             bounds.extend([(None, None)]*3)
             bounds.extend([(-1, 1)]*3)
         q = self.q.copy().ravel()
@@ -426,24 +399,225 @@ class Rotation(object):
         opt = scipy.optimize.minimize(objective, q, method="l-bfgs-b", options={"maxiter": 500, "disp": 0, "ftol": 1e-6}, args=(match, self), bounds=bounds)
         #opt = scipy.optimize.minimize(objective, q, method="nelder-mead", options={"maxiter": 500, "disp": 0, "ftol": 1e-6}, args=(match, self))
         #assert(np.allclose(self.squared_distances, self.analytical_solver(match)))
-        self.update_quaternions(opt.x.reshape((N-1),2,3))
+        # evaluate the squared distances at the solution
+        objective(opt.x, match, self, True)
+        self.update_quaternions(opt.x.reshape((M-1),2,3))
         return self.squared_distances 
 
     def update_quaternions(self, q):
         self.q = q.copy()
 
-    def interaction_arrays(self):
+    def transform_gradient(self, W_r, Q_r, s, rot_grad, trans_grad):
+        """
+        Chain rule for transform_batch.
+        Converts the gradient of a function with respect to the rotation matrices
+        and translation vectors to the gradient with respect to the dual quaternions.
+
+        Parameters:
+        -----------
+        W_r: array
+            K*4*4 sized array of W matrices of the rotation quaternions
+        Q_r: array
+            K*4*4 sized array of Q matrices of the rotation quaternions
+        s: array
+            K*4 sized array of translation quaternions
+        rot_grad: array
+            K*3*3 sized array of derivatives with respect to the rotation matrices
+        trans_grad: array
+            K*3 sized array of derivatives with respect to the translation vectors
+
+        Returns:
+        --------
+        r_grad: array
+            K*4 sized array of derivatives with respect to r
+        s_grad: array
+            K*4 sized array of derivatives with respect to s
+
+        """
+        # derivatives of rot = W_r.T.dot(Q_r) and trans = W_r.T.dot(s) with respect to r
+        # are products with the constant basis matrices.
+        # Only the 3*3 and 3 sized parts are used, so don't compute the rest.
+        W_basis = self.W_basis[:,:,:3]
+        rot_derivatives = np.einsum('lca,kcb->klab', W_basis, Q_r[:,:,:3]) \
+                          + np.einsum('kca,lcb->klab', W_r[:,:,:3], self.Q_basis[:,:,:3])
+        trans_derivatives = np.einsum('lca,kc->kla', W_basis, s)
+
+        r_grad = np.einsum('klab,kab->kl', rot_derivatives, rot_grad) \
+                 + np.einsum('kla,ka->kl', trans_derivatives, trans_grad)
+        s_grad = np.einsum('kca,ka->kc', W_r[:,:,:3], trans_grad)
+        return r_grad, s_grad
+
+    def get_pair_moments(self, match):
+        """
+        Match weighted moments of the coordinates of every (reactant, product) pair.
+
+        For a pair with match sub matrix m, reactant coordinates x and product coordinates y,
+        the energy sum_ab m_ab |R_r x_a + t_r - R_p y_b - t_p|^2 only depends on
+        the coordinates through the moments
+            S0 = sum_ab m_ab
+            x_sum = sum_ab m_ab x_a
+            y_sum = sum_ab m_ab y_b
+            x_moment = sum_ab m_ab x_a x_a^T
+            y_moment = sum_ab m_ab y_b y_b^T
+            cross_moment = sum_ab m_ab x_a y_b^T
+        so the energy and its gradient costs O(1) per pair once these are known.
+
+        Parameters:
+        -----------
+        match: array
+            match matrix
+
+        Returns:
+        --------
+        pair_moments: tuple
+            (S0, x_sum, y_sum, x_moment, y_moment, cross_moment) as
+            N*M, N*M*3, N*M*3, N*M*3*3, N*M*3*3 and N*M*3*3 sized arrays
+            for N reactants and M products
+
+        """
+        N, M = self.M.num_reactants, self.M.num_products
+        S0 = np.empty((N, M))
+        x_sum = np.empty((N, M, 3))
+        y_sum = np.empty((N, M, 3))
+        x_moment = np.empty((N, M, 3, 3))
+        y_moment = np.empty((N, M, 3, 3))
+        cross_moment = np.empty((N, M, 3, 3))
+        # The reactant subsets are consecutive, so the sums over the atoms
+        # of each reactant can be done for all reactants at once with reduceat
+        reactant_starts = [indices[0] for indices in self.M.reactant_subset_indices]
+        X = self.X
+        for j, product_indices in enumerate(self.M.product_subset_indices):
+            Y = self.Y[product_indices]
+            m = match[:, product_indices]
+            row_sums = m.sum(1)
+            # column sums of the block of every reactant
+            column_sums = np.add.reduceat(m, reactant_starts, axis=0)
+            S0[:,j] = column_sums.sum(1)
+            x_sum[:,j] = np.add.reduceat(row_sums[:,None] * X, reactant_starts, axis=0)
+            y_sum[:,j] = column_sums.dot(Y)
+            x_moment[:,j] = np.add.reduceat(row_sums[:,None,None] * self.X_outer, reactant_starts, axis=0)
+            y_moment[:,j] = np.tensordot(column_sums, self.Y_outer[product_indices], 1)
+            cross_moment[:,j] = np.add.reduceat(X[:,:,None] * m.dot(Y)[:,None,:], reactant_starts, axis=0)
+        return S0, x_sum, y_sum, x_moment, y_moment, cross_moment
+
+    def moment_energy(self, rot, trans, pair_moments, jac = False):
+        """
+        Energy, and optionally its gradient with respect to the rotation matrices and
+        translation vectors, computed for all (reactant, product) pairs at once
+        from the moments given by get_pair_moments.
+
+        Parameters:
+        -----------
+        rot: array
+            (N+M-1)*3*3 sized array of rotation matrices
+        trans: array
+            (N+M-1)*3 sized array of translation vectors
+        pair_moments: tuple
+            moments from get_pair_moments
+        jac: bool
+            Compute the gradient as well
+
+        Returns:
+        --------
+        E: float
+            Energy
+        rot_grad: array
+            (N+M-1)*3*3 sized array of derivatives with respect to the rotation matrices.
+            None if jac is False.
+        trans_grad: array
+            (N+M-1)*3 sized array of derivatives with respect to the translation vectors.
+            None if jac is False.
+
+        """
+        N = self.M.num_reactants
+        S0, x_sum, y_sum, x_moment, y_moment, cross_moment = pair_moments
+        # Product 1 is the reference, which is not transformed
+        reactant_rot, reactant_trans = rot[:N,None], trans[:N,None]
+        product_rot = np.concatenate([np.identity(3)[None], rot[N:]])[None]
+        product_trans = np.concatenate([np.zeros((1,3)), trans[N:]])[None]
+
+        diff = reactant_trans - product_trans
+        reactant_x_moment = np.einsum('ijab,ijbc->ijac', reactant_rot, x_moment)
+        product_y_moment = np.einsum('ijab,ijbc->ijac', product_rot, y_moment)
+        product_cross_moment = np.einsum('ijab,ijcb->ijac', product_rot, cross_moment)
+        # difference between the rotated first moments
+        center_diff = np.einsum('ijab,ijb->ija', reactant_rot, x_sum) \
+                      - np.einsum('ijab,ijb->ija', product_rot, y_sum)
+
+        # sum_ab m_ab |R_r x_a + t_r - R_p y_b - t_p|^2 written in terms of the moments
+        # Each rotation matrix is shared by a full row or column of pairs,
+        # so reduce over the pairs before contracting with it
+        E = np.tensordot(reactant_x_moment.sum(1) - 2 * product_cross_moment.sum(1), rot[:N], 3) \
+            + np.tensordot(product_y_moment.sum(0), product_rot[0], 3) \
+            + np.vdot(S0, np.einsum('ija,ija->ij', diff, diff)) + 2 * np.vdot(diff, center_diff)
+
+        if not jac:
+            return E, None, None
+
+        trans_derivative = 2 * (S0[:,:,None] * diff + center_diff)
+        reactant_rot_derivative = 2 * (reactant_x_moment + diff[:,:,:,None] * x_sum[:,:,None,:]
+                                       - product_cross_moment)
+        product_rot_derivative = 2 * (product_y_moment - diff[:,:,:,None] * y_sum[:,:,None,:]
+                                      - np.einsum('ijab,ijbc->ijac', reactant_rot, cross_moment))
+
+        rot_grad = np.concatenate([reactant_rot_derivative.sum(1), product_rot_derivative.sum(0)[1:]])
+        trans_grad = np.concatenate([trans_derivative.sum(1), -trans_derivative.sum(0)[1:]])
+        return E, rot_grad, trans_grad
+
+    def get_transformed_squared_distances(self, rot, trans):
+        """
+        Squared distances between all reactant and product atoms after
+        transforming every molecule but the reference product.
+
+        Parameters:
+        -----------
+        rot: array
+            (N+M-1)*3*3 sized array of rotation matrices
+        trans: array
+            (N+M-1)*3 sized array of translation vectors
+
+        Returns:
+        --------
+        squared_distances: array
+            squared distance matrix
+
+        """
+        N = self.M.num_reactants
+        # Transform every reactant and product once.
+        # Product 1 is used as reference and is not transformed.
+        X_trans = np.empty(self.X.shape)
+        for j, reactant_indices in enumerate(self.M.reactant_subset_indices):
+            X_trans[reactant_indices] = trans[j] + self.X[reactant_indices].dot(rot[j].T)
+        Y_trans = self.Y.copy()
+        for i, product_indices in enumerate(self.M.product_subset_indices[1:]):
+            Y_trans[product_indices] = trans[N+i] + self.Y[product_indices].dot(rot[N+i].T)
+
+        # Every reactant is compared to every product,
+        # so all the blocks can be computed in one go
+        return get_squared_distance_matrix(X_trans, Y_trans)
+
+    def get_distance_buffer(self, n, m):
+        """
+        Scratch array for a n*m sized block of squared distances.
+        The content is only valid until the next request of the same shape.
+
         """
-        Generate W, Q, Qt_dot_W, W_minus_Q arrays from page 363 Walker91
-        disregarding weights (for now)
+        if (n, m) not in self.distance_buffers:
+            self.distance_buffers[n, m] = np.empty((n, m), dtype=np.float64, order='C')
+        return self.distance_buffers[n, m]
 
+    def get_pair_indices(self):
         """
-        # TODO: add ignore hydrogens for calculating the rotations
-        W = np.asarray([self.makeW(*x) for x in self.X])
-        Q = np.asarray([self.makeQ(*y) for y in self.Y])
-        Qt_dot_W = np.asarray([[np.dot(q.T,w) for q in Q] for w in W])
-        W_minus_Q = np.asarray([[w - q for q in Q] for w in W])
-        return W, Q, Qt_dot_W, W_minus_Q
+        Gather the sub matrix indices of every (reactant, product)
+        pair once, since the molecule subsets don't change
+        during the optimization.
+
+        """
+        pair_indices = {}
+        for i, reactant_indices in enumerate(self.M.reactant_subset_indices):
+            for j, product_indices in enumerate(self.M.product_subset_indices):
+                pair_indices[i,j] = np.ix_(reactant_indices, product_indices)
+        return pair_indices
 
     def makeW(self, r1,r2,r3,r4=0):
         # eqn 16 Walker91
@@ -463,11 +637,59 @@ class Rotation(object):
                  [-r1, -r2, -r3, r4] ])
         return Q
 
+    def largest_eigenvector(self, A):
+        """
+        Eigenvector of the largest eigenvalue of the symmetric 4x4 matrix A.
+
+        Only the needed eigenpair is computed, by calling
+        LAPACK dsyevr directly, which avoids the overhead of
+        computing and sorting the full eigen decomposition.
+
+        """
+        # the number of outputs of the wrapper differs between scipy versions
+        output = scipy.linalg.lapack.dsyevr(A, range='I', il=4, iu=4)
+        eigenvectors, info = output[1], output[-1]
+        if info != 0:
+            # fall back to the full decomposition
+            return np.linalg.eigh(A)[1][:,-1]
+        return eigenvectors[:,0]
+
     def transform(self, r, s):
-        Wt_r = self.makeW(*r).T
-        Q_r = self.makeQ(*r)
-        rot = Wt_r.dot(Q_r)[:3,:3]
-        trans = Wt_r.dot(s)[:3]
+        # Single dual quaternion version of transform_batch
+        rot, trans = self.transform_batch(r[None], s[None])
+        return rot[0], trans[0]
+
+    def transform_batch(self, r, s, return_matrices = False):
+        """
+        Vectorized version of transform for K dual quaternions
+
+        Parameters:
+        -----------
+        r: array
+            K*4 sized array of rotation quaternions
+        s: array
+            K*4 sized array of translation quaternions
+        return_matrices: bool
+            Also return the W and Q matrices of r
+
+        Returns:
+        --------
+        rot: array
+            K*3*3 sized array of rotation matrices
+        trans: array
+            K*3 sized array of translation vectors
+        W_r: array
+            K*4*4 sized array of W matrices. Only returned if return_matrices is True
+        Q_r: array
+            K*4*4 sized array of Q matrices. Only returned if return_matrices is True
+
+        """
+        W_r = np.tensordot(r, self.W_basis, 1)
+        Q_r = np.tensordot(r, self.Q_basis, 1)
+        rot = np.einsum('kji,kjl->kil', W_r[:,:,:3], Q_r[:,:,:3])
+        trans = np.einsum('kji,kj->ki', W_r[:,:,:3], s)
+        if return_matrices:
+            return rot, trans, W_r, Q_r
         return rot, trans
 
 class Atomic(object):
@@ -488,14 +710,16 @@ class Atomic(object):
 
         # the score matrix is created such that a perfect match is 0
         # and imperfect matches are positive
-        score_matrix = np.zeros(self.M.match_matrix.shape)
+        sybyl_mismatch = (self.M.reactants_sybyl_types[:, None] != self.M.products_sybyl_types[None,:])
+        element_mismatch = (self.M.reactants_elements[:, None] != self.M.products_elements[None,:])
 
         # sybyl match matrix
-        score_matrix += settings.atomic_sybyl_weight * (self.M.reactants_sybyl_types[:, None] != self.M.products_sybyl_types[None,:])
+        score_matrix = np.multiply(settings.atomic_sybyl_weight, sybyl_mismatch, dtype=float)
 
-        # enforce that elements only match other elements of same type
-
-        score_matrix += 1e6 * (self.M.reactants_elements[:, None] != self.M.products_elements[None,:])
+        # enforce that elements only match other elements of same type.
+        # A large finite penalty is used rather than inf, since the match matrix
+        # underflows to zero there and 0*inf would give nan in the weighted scores
+        np.add(score_matrix, 1e6, out=score_matrix, where=element_mismatch)
 
         return score_matrix
 
@@ -529,43 +753,63 @@ class Bond(object):
     def __init__(self, M):
         oprint(3, "Initializing bond objective")
         self.M = M
-        self.matrix_function = self.get_matrix_function()
-        self.evaluate_score_matrix_vect = np.vectorize(self.evaluate_score_matrix, otypes=[np.float], excluded=['match'])
+        self.score_operator = self.get_score_operator()
+
+    def get_bond_pairs(self):
+        """
+        Find all possible bond matches.
 
-    def get_matrix_function(self):
+        A reactant bond a-b can be matched to a product bond i-j
+        if the elements of the two bonds are the same, in either order.
+
+        Returns:
+        --------
+        bond_pairs: tuple
+            (a, i, b, j) integer arrays, where each element of the
+            arrays describes a bond match. The score of matching a to i
+            is then the sum of match[b,j] over all matches with the same (a,i).
+
+        """
 
         reactant_elements = self.M.reaction.reactants.element_symbols
         product_elements = self.M.reaction.products.element_symbols
         reactant_bond_matrix = self.M.reaction.reactants.bond_matrix
         product_bond_matrix = self.M.reaction.products.bond_matrix
 
-        # Construct a matrix function for easy evaluation of the objective
-        C = np.empty(self.M.match_matrix.shape, dtype = object)
-        # Fill it with functions that returns zero
-        for a,i in itertools.product(xrange(reactant_elements.size),xrange(product_elements.size)):
-            C[a,i] = lambda x: 0
-
-        # temporary helper dict to construct the matrix
-        pairs = {}
-
-        # fill pairs with all possible bond matches
-        for a,b in zip(*np.where(reactant_bond_matrix)):
-            element_a, element_b = reactant_elements[[a,b]]
-            for i,j in zip(*np.where(product_bond_matrix)):
-                element_i, element_j = reactant_elements[[i,j]]
-                if (element_a == element_i and element_b == element_j) or (element_a == element_j and element_b == element_i):
-                    if (a,i) not in pairs: pairs[(a,i)] = []
-                    pairs[a,i].append((b,j))
-
-        # construct the matrix function
-        for (a,i), container in pairs.items():
-            # y=container makes sure that the values of b,j can be used outside the local scope
-            C[a,i] = lambda x, y=container: np.sum((x[b,j] for (b,j) in y))
-
-        return C
+        # all reactant bonds a-b and product bonds i-j.
+        # The bond matrices are symmetric, so every bond is only taken once
+        a, b = np.where(np.triu(reactant_bond_matrix, 1))
+        i, j = np.where(np.triu(product_bond_matrix, 1))
+
+        # compare the elements of every reactant bond with every product bond at once,
+        # by lookup in the element equality of every reactant and product atom
+        same_element = (reactant_elements[:,None] == product_elements[None,:])
+        same_a, same_b = same_element[a], same_element[b]
+        # a-b matches i-j, or it matches j-i
+        parallel_reactant_indices, parallel_product_indices = np.nonzero(same_a[:,i] & same_b[:,j])
+        crossed_reactant_indices, crossed_product_indices = np.nonzero(same_a[:,j] & same_b[:,i])
+        a1, b1 = a[parallel_reactant_indices], b[parallel_reactant_indices]
+        i1, j1 = i[parallel_product_indices], j[parallel_product_indices]
+        a2, b2 = a[crossed_reactant_indices], b[crossed_reactant_indices]
+        i2, j2 = i[crossed_product_indices], j[crossed_product_indices]
+
+        # every matched pair of bonds gives the match and its reverse,
+        # such that atoms are only paired with atoms of the same element
+        return np.concatenate([a1, b1, a2, b2]), np.concatenate([i1, j1, j2, i2]), \
+               np.concatenate([b1, a1, b2, a2]), np.concatenate([j1, i1, i2, j2])
+
+    def get_score_operator(self):
+        """
+        Sparse matrix C such that C.dot(match.ravel()) is the
+        raveled sum of match[b,j] over all bond matches of each (a,i).
 
-    def evaluate_score_matrix(self, a, i, match):
-        return self.matrix_function[a,i](match)
+        """
+        a, i, b, j = self.get_bond_pairs()
+        size = self.M.match_matrix.size
+        num_products = self.M.match_matrix.shape[1]
+        # duplicate entries are summed during the conversion to csr
+        C = scipy.sparse.coo_matrix((np.ones(a.size), (a * num_products + i, b * num_products + j)), shape=(size, size))
+        return C.tocsr()
 
     def score(self, match):
         """
@@ -582,7 +826,7 @@ class Bond(object):
 
         """
 
-        score_matrix = -settings.bond_weight * np.fromfunction(self.evaluate_score_matrix_vect, match.shape, match=match, dtype=int)
+        score_matrix = self.score_operator.dot(match.ravel()).reshape(match.shape)
+        score_matrix *= -settings.bond_weight
 
         return score_matrix
-
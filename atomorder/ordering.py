@@ -302,7 +302,7 @@ class Ordering(object):
 
             self.relaxation()
 
-            row_l2_deviation = abs(1 - np.sum(self.match_matrix**2)/N)
+            row_l2_deviation = abs(1 - np.vdot(self.match_matrix, self.match_matrix)/N)
 
             if row_l2_deviation < self.annealing_convergence_threshold and self.row_dominance():
                 oprint(4, "Annealing algorithm converged in iteration %d" % (it+1))
@@ -412,7 +412,7 @@ class Ordering(object):
             for i in range(N):
                 M2[i,rd[i]] = 1
 
-            print np.sum(abs(M1-M2))
+            oprint(4, "Difference between diagonal ordering and found ordering: " + str(np.sum(abs(M1-M2))))
 
             scores1 = [fun.score(M1) for fun in self.obj]
             scores2 = [fun.score(M2) for fun in self.obj]
@@ -420,5 +420,5 @@ class Ordering(object):
             #    for j in range(M):
             #        if M1[i,j] + M2[i,j] > 0.9:
             #            print i, j, [(scores1[k][i,j],scores2[k][i,j]) for k in range(3)]
-            oprint(4, "Scores of diagonal ordering compared to found ordering: " + str([(np.sum(M1*scores1[k]), np.sum(M2*scores2[k])) for k in range(len(scores1))]))
+            oprint(4, "Scores of diagonal ordering compared to found ordering: " + str([(np.vdot(M1, scores1[k]), np.vdot(M2, scores2[k])) for k in range(len(scores1))]))
 
@@ -31,6 +31,8 @@ parser.add_argument('-m', '--method', help='Method to use.\n \
 parser.add_argument('-o', '--output', help='Given a filename, output the reordered product in xyz format instead of printing to stdout', action='store', type=str, default=sys.stdout)
 parser.add_argument('--atomic-sybyl-weight', action='store', default=1, type=float)
 parser.add_argument('--bond-weight', action='store', default=1, type=float)
+parser.add_argument('--force-numerical', help='Use the fully numerical rotation solver for all numbers of reactants and products',
+                                         action='store_true', default=False)
 # TODO output to folder
 # TODO output atom mapping oneline, save reordered products
 # TODO allow possibility to give pickle with reaction object
@@ -161,6 +161,8 @@ class Molecule(object):
     element_symbols: array_like
         N-size array of names of the molecule atoms
         e.g. ['H', 'C']
+    atomic_numbers: array_like
+        N-size array of atomic numbers of the molecule atoms
     coordinates: array_like
         Nx3-size array of euclidian coordinates of the molecule atoms
     size: integer
@@ -189,6 +191,7 @@ class Molecule(object):
         self.mixture_index = index
         self.filename = filename
         self.element_symbols, self.coordinates = read_coordinates(self.filename)
+        self.atomic_numbers = constants.get_atomic_numbers(self.element_symbols)
         self.monovalent = self.get_monovalent_indices()
         self.size = self.element_symbols.size
         self.distance_matrix = None
@@ -330,7 +333,7 @@ class Molecule(object):
         return utils.get_distance(self.coordinates[None,:,:],self.coordinates[:,None,:], axis = -1)
 
     def get_monovalent_indices(self):
-        return np.in1d(self.element_symbols, constants.monovalent, invert = False)
+        return constants.monovalent_mask[self.atomic_numbers]
 
     def make_atoms(self):
         """
@@ -368,16 +371,11 @@ class Molecule(object):
 
         pair_distances = self.distance_matrix[pair_indices]
 
-        # create arrays of typical bond length limits (size 4 x n_pairs)
-        limits = np.asarray([constants.get_bond_length_limits(self.element_symbols[i],self.element_symbols[j]) for i,j in zip(*pair_indices)]
-                            , dtype=float).T
-
-        # bonds within the 'usual' range
-        credible_bonds = (pair_distances >= limits[1]) & (pair_distances <= limits[2])
-
+        # bonds within the 'usual' range (credible_bonds) and
+        # bonds outside the usual range but within a looser restricted range (less_credible_bonds)
         # NOTE: could probably do without the less_credible_bonds range, but shouldn't be a bottleneck of any sorts
-        # bonds outside the usual range but within a looser restricted range
-        less_credible_bonds = (~credible_bonds) & (pair_distances >= limits[0]) & (pair_distances <= limits[3])
+        credible_bonds, less_credible_bonds = constants.classify_bonds(self.atomic_numbers[pair_indices[0]],
+                                                                       self.atomic_numbers[pair_indices[1]], pair_distances)
 
         credible_bond_indices = np.asarray(zip(*pair_indices))[credible_bonds]
         less_credible_bond_indices = np.asarray(zip(*pair_indices))[less_credible_bonds]
@@ -493,6 +491,8 @@ class Atom(object):
         Parent Molecule object
     element_symbol: string
         Atomtype, e.g. 'H' or 'Cl'
+    atomic_number: integer
+        Atomic number of the element
     molecule_index: integer
         Index of atom in the molecule
     mixture_index: integer
@@ -521,6 +521,7 @@ class Atom(object):
 
     def __init__(self, index, molecule):
         self.element_symbol = molecule.element_symbols[index]
+        self.atomic_number = molecule.atomic_numbers[index]
         self.molecule_index = index
         self.mixture_index = index
         self.coordinates = molecule.coordinates[index]
@@ -728,8 +729,8 @@ class Atom(object):
         if self.element_symbol not in constants.number_bonds:
             eprint(2, "WARNING: element %s not completely implemented, but ordering should still work")
             return True
+        if (constants.valence_mask[self.atomic_number] >> self.num_bonds) & 1: return 0
         possible_num_bonds = constants.number_bonds[self.element_symbol]
-        if self.num_bonds in possible_num_bonds: return 0
         if self.num_bonds < possible_num_bonds.min(): return possible_num_bonds.min() - self.num_bonds
         if self.num_bonds > possible_num_bonds.max(): return self.num_bonds - possible_num_bonds.max()
 
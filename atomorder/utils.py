@@ -45,7 +45,45 @@ def eprint(level, string):
         __builtin__.print(string, file = sys.stderr)
 
 def get_distance(x, y, axis):
-    return np.sum((x-y)**2, axis=axis)**0.5
+    # square and take the root in place, such that the
+    # broadcasted difference is the only temporary array
+    difference = np.subtract(x, y)
+    np.multiply(difference, difference, out=difference)
+    distance = difference.sum(axis=axis)
+    np.sqrt(distance, out=distance)
+    return distance
+
+def get_squared_distance_matrix(x, y, out = None):
+    """
+    Squared euclidean distances between all points in x and y
+
+    Expands |x-y|^2 = |x|^2 + |y|^2 - 2x.y, such that the (n,m,3) sized
+    array of differences is never formed and the cross term is a single
+    matrix product.
+
+    Parameters
+    ----------
+    x: array
+        n*3 sized array of coordinates
+    y: array
+        m*3 sized array of coordinates
+    out: array, optional
+        C-contiguous n*m sized float array to store the result in,
+        such that no new array is allocated
+
+    Returns
+    -------
+    squared_distances: array
+        n*m sized array of squared distances
+
+    """
+    squared_distances = np.dot(x, y.T, out=out)
+    squared_distances *= -2
+    squared_distances += np.einsum('ij,ij->i', x, x)[:,None]
+    squared_distances += np.einsum('ij,ij->i', y, y)[None,:]
+    # remove negative values from round-off
+    np.maximum(squared_distances, 0, out=squared_distances)
+    return squared_distances
 
 # http://stackoverflow.com/a/13849249
 def vector_angle(v1,v2):
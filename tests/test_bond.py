@@ -0,0 +1,64 @@
+"""
+tests/test_bond.py
+
+Bond objective scores on examples/reaction
+
+"""
+
+import os
+import argparse
+import unittest
+import numpy as np
+
+from atomorder import settings, objectives, Reaction, Ordering
+
+examples = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "examples", "reaction")
+
+class TestBond(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        args = argparse.Namespace(reactants=[os.path.join(examples, "R2.xyz"), os.path.join(examples, "R1.xyz")],
+                                  products=[os.path.join(examples, "P.xyz")], print_level=0, format="guess",
+                                  method="full", output=None, atomic_sybyl_weight=1.0, bond_weight=1.0,
+                                  force_numerical=False)
+        settings.update(args)
+        reaction = Reaction()
+        # Only the attributes used by the bond objective, without doing the annealing
+        cls.M = Ordering.__new__(Ordering)
+        cls.M.reaction = reaction
+        cls.M.match_matrix = np.zeros((reaction.reactants.element_symbols.size, reaction.products.element_symbols.size))
+        cls.bond = objectives.Bond(cls.M)
+
+    def test_no_element_mismatches(self):
+        reactant_elements = self.M.reaction.reactants.element_symbols
+        product_elements = self.M.reaction.products.element_symbols
+        a, i, b, j = self.bond.get_bond_pairs()
+        self.assertTrue(a.size > 0)
+        self.assertTrue((reactant_elements[a] == product_elements[i]).all())
+        self.assertTrue((reactant_elements[b] == product_elements[j]).all())
+
+    def test_score(self):
+        # score[a,i] = -bond_weight * sum of match[b,j] over the reactant bonds a-b
+        # and product bonds i-j where a, i and b, j are the same elements
+        reactant_elements = self.M.reaction.reactants.element_symbols
+        product_elements = self.M.reaction.products.element_symbols
+        reactant_bond_matrix = self.M.reaction.reactants.bond_matrix
+        product_bond_matrix = self.M.reaction.products.bond_matrix
+
+        match = np.random.RandomState(0).rand(*self.M.match_matrix.shape)
+        N, M = match.shape
+        reference = np.zeros(match.shape)
+        for a in range(N):
+            for i in range(M):
+                if reactant_elements[a] != product_elements[i]:
+                    continue
+                for b in np.where(reactant_bond_matrix[a])[0]:
+                    for j in np.where(product_bond_matrix[i])[0]:
+                        if reactant_elements[b] == product_elements[j]:
+                            reference[a,i] -= settings.bond_weight * match[b,j]
+
+        self.assertTrue(np.allclose(self.bond.score(match), reference))
+
+if __name__ == "__main__":
+    unittest.main()